@@ -4,84 +4,227 @@
 #
 # Learn more at: https://juju.is/docs/sdk
 
+import functools
+import hashlib
 import logging
+import os
 import yaml
-from pydantic import BaseModel
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Mapping
 
 import ops
 
 from pathlib import Path
 
-from charms.operator_libs_linux.v2 import snap
-from charms.grafana_agent.v0.cos_agent import COSAgentProvider
+if TYPE_CHECKING:
+    # The snap lib and cos_agent (which pulls in cosl and pydantic) are imported
+    # where they are used, so hooks that need neither don't load them.
+    from charms.grafana_agent.v0.cos_agent import COSAgentProvider
+    from charms.operator_libs_linux.v2 import snap
 
 # Log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
 
 RESOURCE_NAME = "exporter-snap"
+# Prefer the libyaml-backed loader when available
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+STATUS_INSTALLED = ops.MaintenanceStatus("snap installed")
+STATUS_CONFIGURED = ops.ActiveStatus("configured")
 
 class SnapNameNotConfigured(Exception):
     pass
 
-class ExporterConfig(BaseModel):
+def _hash_resource(path: Path) -> tuple[str, os.stat_result]:
+    """Return the hex encoded sha256 and the stat of a file, opening it only once."""
+    with path.open("rb") as f:
+        st = os.fstat(f.fileno())
+        if hasattr(hashlib, "file_digest"):  # python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest(), st
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+        return digest.hexdigest(), st
+
+def _sha256(*parts: str) -> str:
+    """Return the hex encoded sha256 of the given strings."""
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+@dataclass(frozen=True, slots=True)
+class ExporterConfig:
     exporter_port: int
-    snap_name: str | None = None
-    snap_config: str | None = None
     snap_channel: str
     classic: bool
     metrics_path: str
+    snap_name: str | None = None
+    snap_config: str | None = None
     alert_rules: str | None = None
 
+    @classmethod
+    def from_juju(cls, raw: Mapping[str, Any]) -> "ExporterConfig":
+        """Build the config from the charm config, raising ValueError if it is invalid."""
+        missing = [
+            key for key in ("exporter-port", "snap-channel", "classic", "metrics-path")
+            if key not in raw
+        ]
+        if missing:
+            raise ValueError(f"Missing required config: {', '.join(missing)}")
+        try:
+            port = int(raw["exporter-port"])
+        except (TypeError, ValueError):
+            raise ValueError(
+                f"exporter-port must be an integer, got {raw['exporter-port']!r}"
+            ) from None
+        if not isinstance(raw["classic"], bool):
+            raise ValueError(f"classic must be a boolean, got {raw['classic']!r}")
+        return cls(
+            exporter_port=port,
+            snap_channel=str(raw["snap-channel"]),
+            classic=raw["classic"],
+            metrics_path=str(raw["metrics-path"]),
+            snap_name=raw.get("snap-name"),
+            snap_config=raw.get("snap-config"),
+            alert_rules=raw.get("alert-rules"),
+        )
+
 class GenericExporterCharm(ops.CharmBase):
     """Install and configure any prometheus exporter snap."""
 
+    _stored = ops.StoredState()
+
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
+        self._stored.set_default(
+            resource_path=None,
+            resource_mtime=None,
+            resource_size=None,
+            resource_digest=None,
+            snap_config_hash=None,
+            snap_hash=None,
+        )
         try:
-            self._config = self.load_config(ExporterConfig)
+            self._config = ExporterConfig.from_juju(self.config)
         except ValueError as e:
-            logger.error(f'Configuration error: {e}')
+            logger.error("Configuration error: %s", e)
             self.unit.status = ops.BlockedStatus(str(e))
             return
 
-        self.rules_dir = Path(f"/etc/{self.app.name}/")
-
-        self.framework.observe(self.on.install, self._install_snap)
+        self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.config_changed, self._configure)
-        self.framework.observe(self.on.upgrade_charm, self._install_snap)
-
-        # COS integration
-        self.cos = COSAgentProvider(
-            self,
-            metrics_endpoints=[{
-                "path": f'/{self._config.metrics_path}',
-                "port": self._config.exporter_port
-            }],
-            metrics_rules_dir=self.rules_dir,
-            refresh_events=[self.on.config_changed],
-        )
+        self.framework.observe(self.on.upgrade_charm, self._on_install)
+
+        # COS integration, only set up when the relation exists. relation-created
+        # already lists the new relation, so the provider sees all of its events.
+        self.cos: "COSAgentProvider | None" = None
+        if self.model.relations["cos-agent"]:
+            from charms.grafana_agent.v0.cos_agent import COSAgentProvider
+
+            self.cos = COSAgentProvider(
+                self,
+                metrics_endpoints=[{
+                    "path": f'/{self._config.metrics_path}',
+                    "port": self._config.exporter_port
+                }],
+                metrics_rules_dir=str(self.rules_dir),
+                refresh_events=[self.on.config_changed],
+            )
+
+    @functools.cached_property
+    def rules_dir(self) -> Path:
+        """Directory the alert rules are written to and read from by cos-agent."""
+        return Path("/etc") / self.app.name
+
+    @functools.cached_property
+    def _snap_cache(self) -> "snap.SnapCache":
+        """SnapCache shared by install and configure within one hook."""
+        from charms.operator_libs_linux.v2 import snap
+
+        return snap.SnapCache()
+
+    @property
+    def _installed_marker(self) -> Path:
+        # Kept as a file rather than in StoredState: StoredState is only committed when
+        # the hook succeeds, while the marker records the install as soon as it happened,
+        # so a hook that fails afterwards doesn't cause a reinstall on retry.
+        return self.charm_dir / ".installed-snap-digest"
+
+    def _installed(self) -> tuple[str, str] | None:
+        """Return the (key, snap name) of the last successful install, if any."""
+        try:
+            key, name = self._installed_marker.read_text(encoding="utf-8").split()
+        except (FileNotFoundError, ValueError):
+            return None
+        return key, name
+
+    def _record_installed(self, key: str, name: str):
+        self._installed_marker.write_text(f"{key} {name}\n", encoding="utf-8")
+
+    def _unchanged_resource(self, event) -> tuple[Path, str] | None:
+        """Return (path, digest) of the last fetched resource if it is untouched on disk.
+
+        Attaching a new resource fires upgrade-charm, so the resource is always re-fetched there.
+        """
+        if isinstance(event, ops.UpgradeCharmEvent) or not self._stored.resource_path:
+            return None
+        if not self._installed_marker.exists():
+            return None
+        path = Path(self._stored.resource_path)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        stored = (self._stored.resource_mtime, self._stored.resource_size)
+        if (st.st_mtime_ns, st.st_size) != stored:
+            return None
+        return path, self._stored.resource_digest
+
+    def _fetch_resource(self) -> tuple[Path, str]:
+        """Fetch the snap resource and remember its digest and stat for later hooks."""
+        path = self.model.resources.fetch(RESOURCE_NAME)
+        digest, st = _hash_resource(path)
+        if st.st_size == 0:
+            raise ops.model.ModelError("Resource File is empty")
+        self._stored.resource_path = str(path)
+        self._stored.resource_mtime = st.st_mtime_ns
+        self._stored.resource_size = st.st_size
+        self._stored.resource_digest = digest
+        return path, digest
 
-    # Todo: We install each config changed hook. We should hash the snap and only install if there's a change.
     def _install_from_resource(self, resource_path: Path):
+        from charms.operator_libs_linux.v2 import snap
+
         logger.info("Installing snap from resource %s", resource_path)
-        if resource_path.stat().st_size == 0:
-            raise ops.model.ModelError("Resource File is empty")
         exporter_snap = snap.install_local(filename=str(resource_path), dangerous=True, classic=self._config.classic)
         return exporter_snap.name
 
     def _install_from_store(self, name):
-        cache = snap.SnapCache()
-        logger.info(f"Installing snap {name} from store, classic confinement is {self._config.classic} and channel is {self._config.snap_channel}")
+        from charms.operator_libs_linux.v2 import snap
+
+        cache = self._snap_cache
+        logger.info(
+            "Installing snap %s from store, classic confinement is %s and channel is %s",
+            name, self._config.classic, self._config.snap_channel,
+        )
         installed = cache[name]
         if not installed.present:
             installed.ensure(snap.SnapState.Latest, classic=self._config.classic, channel=self._config.snap_channel)
 
+    def _on_install(self, event):
+        # Only an intermediate status, the config-changed that Juju fires next sets the final one.
+        self._install_snap(event)
+        self.unit.status = STATUS_INSTALLED
+
     def _install_snap(self, event = None) -> str:
-        """Install snap from resource or store."""
+        """Install snap from resource or store. The caller sets the final status."""
+        installed = self._installed()
         try:
-            path = self.model.resources.fetch(RESOURCE_NAME)
-            name = self._install_from_resource(path)
-            self.unit.status = ops.ActiveStatus("snap installed")
+            path, digest = self._unchanged_resource(event) or self._fetch_resource()
+            key = f"resource:{digest}:{self._config.classic}"
+            if installed and installed[0] == key:
+                logger.info("Snap resource unchanged, skipping install")
+                name = installed[1]
+            else:
+                name = self._install_from_resource(path)
+                self._record_installed(key, name)
             return name
         except ops.model.ModelError:
             logger.info("No resource configured, will use snapstore")
@@ -93,27 +236,84 @@ class GenericExporterCharm(ops.CharmBase):
             self.unit.status = ops.BlockedStatus(err)
             raise SnapNameNotConfigured(err)
 
-        self._install_from_store(cfg_name)
-        self.unit.status = ops.ActiveStatus("snap installed")
+        key = f"store:{cfg_name}:{self._config.snap_channel}:{self._config.classic}"
+        if installed and installed[0] == key:
+            logger.info("Snap %s already installed, skipping install", cfg_name)
+        else:
+            self._install_from_store(cfg_name)
+            self._record_installed(key, cfg_name)
         return self._config.snap_name
 
-    def _configure(self, _):
-        """Apply snap configuration and alert rules."""
-        name = self._install_snap()
-        snap_config = yaml.safe_load(self._config.snap_config or "")
+    def _apply_snap_config(self, name: str):
+        """Pass snap-config to the snap, unless it was already applied to this install."""
+        raw = self._config.snap_config or ""
+        # keyed on the install as well, so a newly installed snap gets the config again
+        config_hash = _sha256(str(self._installed()), name, raw)
+        if config_hash == self._stored.snap_config_hash:
+            logger.info("Snap config unchanged, not setting it again")
+            return
+        if not raw:
+            snap_config = None
+        else:
+            snap_config = yaml.load(raw, Loader=Loader)
         if snap_config and snap_config != "None":
-            logger.info(f"Setting snap config to {snap_config}")
-            cache = snap.SnapCache()
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Setting snap config to %r", snap_config)
+            cache = self._snap_cache
             exporter = cache[name]
             exporter.set(snap_config, typed=True)
+        self._stored.snap_config_hash = config_hash
+
+    def _snap_hash(self) -> str:
+        """Hash of everything that decides how the snap is installed and configured.
+
+        The installed marker is included, so the config-changed that follows installing a
+        new resource in upgrade-charm gets past this check and re-applies snap-config.
+        """
+        return _sha256(
+            str(self._installed()),
+            str(self._config.snap_name),
+            self._config.snap_channel,
+            str(self._config.classic),
+            self._config.snap_config or "",
+        )
+
+    def _write_alert_rules(self):
+        """Write alert rules, only touching the file if the content changed."""
+        rules_dir = self.rules_dir
+        target = rules_dir / "alerts.rules"
+        rules = (self._config.alert_rules or "# no alerts\n").encode("utf-8")
+        try:
+            unchanged = target.read_bytes() == rules
+        except FileNotFoundError:
+            rules_dir.mkdir(parents=True, exist_ok=True)
+            unchanged = False
+        if not unchanged:
+            tmp = rules_dir / ".alerts.rules.tmp"
+            try:
+                tmp.write_bytes(rules)
+                os.replace(tmp, target)
+            except OSError:
+                tmp.unlink(missing_ok=True)
+                raise
+
+    def _configure(self, _):
+        """Apply snap configuration and alert rules."""
+        if self._snap_hash() != self._stored.snap_hash:
+            name = self._install_snap()
+            self._apply_snap_config(name)
+            # recompute, the install may just have written the marker
+            self._stored.snap_hash = self._snap_hash()
+        else:
+            logger.info("Snap settings unchanged, nothing to install or configure")
 
-        # write alert rules
-        rules_dir = Path(self.rules_dir)
-        rules_dir.mkdir(parents=True, exist_ok=True)
-        rules = self._config.alert_rules
-        (rules_dir / "alerts.rules").write_text(rules or "# no alerts\n")
+        # Always called, it compares against the file on disk, so a deleted or
+        # modified rules file is restored without rewriting an unchanged one.
+        self._write_alert_rules()
 
-        self.unit.status = ops.ActiveStatus("configured")
+        # config-changed always follows install and upgrade-charm, so this is the
+        # status the unit settles on, including when nothing had to be done
+        self.unit.status = STATUS_CONFIGURED
 
 
 if __name__ == "__main__":
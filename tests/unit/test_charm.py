@@ -0,0 +1,314 @@
+# Copyright 2025 Marcus Boden (marcus.boden@canonical.com)
+# See LICENSE file for licensing details.
+
+import dataclasses
+from unittest.mock import MagicMock
+
+import ops
+import pytest
+from charms.operator_libs_linux.v2 import snap
+from ops import testing
+
+from charm import ExporterConfig, GenericExporterCharm
+
+CONFIG = {"exporter-port": 9100, "snap-name": "node-exporter"}
+
+
+@pytest.fixture
+def rules_dir(tmp_path, monkeypatch):
+    path = tmp_path / "rules"
+    monkeypatch.setattr(GenericExporterCharm, "rules_dir", property(lambda _: path))
+    return path
+
+
+@pytest.fixture
+def snap_cache(monkeypatch):
+    cache = MagicMock()
+    cache["node-exporter"].present = False
+    monkeypatch.setattr(snap, "SnapCache", lambda: cache)
+    return cache
+
+
+@pytest.fixture
+def install_local(monkeypatch):
+    mock = MagicMock()
+    mock.return_value.name = "local-exporter"
+    monkeypatch.setattr(snap, "install_local", mock)
+    return mock
+
+
+@pytest.fixture
+def ctx(tmp_path, rules_dir, snap_cache, install_local):
+    charm_root = tmp_path / "charm"
+    charm_root.mkdir()
+    return testing.Context(GenericExporterCharm, charm_root=charm_root)
+
+
+@pytest.fixture
+def no_resource(monkeypatch):
+    # scenario raises a RuntimeError for resources missing from the State, Juju a ModelError
+    def fetch(self, name):
+        raise ops.ModelError(f"resource {name} not attached")
+
+    monkeypatch.setattr(ops.model.Resources, "fetch", fetch)
+
+
+@pytest.fixture
+def resource(tmp_path):
+    path = tmp_path / "prometheus-exporter.snap"
+    path.write_bytes(b"not really a snap")
+    return testing.Resource(name="exporter-snap", path=path)
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_store_install_skipped_when_unchanged(ctx, snap_cache):
+    state = ctx.run(ctx.on.install(), testing.State(config=CONFIG))
+    state = ctx.run(ctx.on.upgrade_charm(), state)
+    snap_cache["node-exporter"].ensure.assert_called_once()
+
+    config = {**CONFIG, "snap-channel": "latest/edge"}
+    ctx.run(ctx.on.upgrade_charm(), dataclasses.replace(state, config=config))
+    assert snap_cache["node-exporter"].ensure.call_count == 2
+
+
+def test_resource_install_skipped_when_unchanged(ctx, install_local, resource):
+    state = ctx.run(ctx.on.install(), testing.State(config=CONFIG, resources={resource}))
+    ctx.run(ctx.on.upgrade_charm(), state)
+    install_local.assert_called_once()
+
+
+def test_upgrade_with_new_resource_reinstalls(ctx, install_local, resource):
+    state = testing.State(config=CONFIG, resources={resource})
+    state = ctx.run(ctx.on.install(), state)
+    resource.path.write_bytes(b"a newer snap")
+
+    ctx.run(ctx.on.upgrade_charm(), state)
+    assert install_local.call_count == 2
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_alert_rules_written(ctx, rules_dir):
+    ctx.run(ctx.on.config_changed(), testing.State(config=CONFIG))
+    assert (rules_dir / "alerts.rules").read_text() == "# no alerts\n"
+
+    rules = "groups: []\n"
+    ctx.run(ctx.on.config_changed(), testing.State(config={**CONFIG, "alert-rules": rules}))
+    assert (rules_dir / "alerts.rules").read_text() == rules
+    assert not (rules_dir / ".alerts.rules.tmp").exists()
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_failed_rules_write_leaves_no_temp_file(ctx, rules_dir, monkeypatch):
+    def replace(src, dst):
+        raise OSError("read-only file system")
+
+    monkeypatch.setattr("charm.os.replace", replace)
+    with pytest.raises(testing.errors.UncaughtCharmError):
+        ctx.run(ctx.on.config_changed(), testing.State(config=CONFIG))
+    assert list(rules_dir.iterdir()) == []
+
+
+@pytest.fixture
+def fetch_calls(monkeypatch):
+    calls = []
+    fetch = ops.model.Resources.fetch
+
+    def counting_fetch(self, name):
+        calls.append(name)
+        return fetch(self, name)
+
+    monkeypatch.setattr(ops.model.Resources, "fetch", counting_fetch)
+    return calls
+
+
+def test_unchanged_resource_not_fetched_again(ctx, install_local, resource, fetch_calls):
+    state = ctx.run(ctx.on.install(), testing.State(config=CONFIG, resources={resource}))
+    assert len(fetch_calls) == 1
+
+    config = {**CONFIG, "snap-channel": "latest/edge"}
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, config=config))
+    assert len(fetch_calls) == 1
+
+    # upgrade-charm is where a newly attached resource shows up
+    ctx.run(ctx.on.upgrade_charm(), state)
+    assert len(fetch_calls) == 2
+    install_local.assert_called_once()
+
+
+def test_modified_resource_fetched_again(ctx, install_local, resource, fetch_calls):
+    state = ctx.run(ctx.on.install(), testing.State(config=CONFIG, resources={resource}))
+    resource.path.write_bytes(b"a newer snap")
+
+    ctx.run(ctx.on.config_changed(), state)
+    assert len(fetch_calls) == 2
+    assert install_local.call_count == 2
+
+
+def test_snap_config_not_set_again_when_unchanged(ctx, snap_cache, resource):
+    config = {**CONFIG, "snap-config": "collectors: [cpu]"}
+    state = testing.State(config=config, resources={resource})
+    state = ctx.run(ctx.on.install(), state)
+    state = ctx.run(ctx.on.config_changed(), state)
+    exporter = snap_cache["local-exporter"]
+    exporter.set.assert_called_once_with({"collectors": ["cpu"]}, typed=True)
+
+    # snap-name is ignored while a resource is attached, the config is already applied
+    config = {**config, "snap-name": "other-exporter"}
+    ctx.run(ctx.on.config_changed(), dataclasses.replace(state, config=config))
+    exporter.set.assert_called_once()
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_reverted_config_clears_blocked(ctx, snap_cache):
+    state = ctx.run(ctx.on.config_changed(), testing.State(config=CONFIG))
+    assert state.unit_status == testing.ActiveStatus("configured")
+
+    invalid = {"snap-name": "node-exporter"}
+    state = ctx.run(ctx.on.config_changed(), testing.State(
+        config=invalid, stored_states=state.stored_states
+    ))
+    assert isinstance(state.unit_status, testing.BlockedStatus)
+
+    state = ctx.run(ctx.on.config_changed(), testing.State(
+        config=CONFIG, stored_states=state.stored_states, unit_status=state.unit_status
+    ))
+    assert state.unit_status == testing.ActiveStatus("configured")
+    snap_cache["node-exporter"].ensure.assert_called_once()
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_rules_only_change(ctx, snap_cache, rules_dir):
+    state = ctx.run(ctx.on.config_changed(), testing.State(config=CONFIG))
+
+    rules = "groups: []\n"
+    state = ctx.run(ctx.on.config_changed(), testing.State(
+        config={**CONFIG, "alert-rules": rules}, stored_states=state.stored_states
+    ))
+    assert (rules_dir / "alerts.rules").read_text() == rules
+    assert state.unit_status == testing.ActiveStatus("configured")
+    snap_cache["node-exporter"].ensure.assert_called_once()
+    snap_cache["node-exporter"].set.assert_not_called()
+
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_snap_only_change(ctx, snap_cache, rules_dir):
+    state = ctx.run(ctx.on.config_changed(), testing.State(config=CONFIG))
+
+    state = ctx.run(ctx.on.config_changed(), testing.State(
+        config={**CONFIG, "snap-config": "collectors: [cpu]"}, stored_states=state.stored_states
+    ))
+    snap_cache["node-exporter"].set.assert_called_once_with(
+        {"collectors": ["cpu"]}, typed=True
+    )
+    snap_cache["node-exporter"].ensure.assert_called_once()
+    assert (rules_dir / "alerts.rules").read_text() == "# no alerts\n"
+    assert state.unit_status == testing.ActiveStatus("configured")
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_deleted_rules_file_is_restored(ctx, rules_dir):
+    state = ctx.run(ctx.on.config_changed(), testing.State(config=CONFIG))
+    (rules_dir / "alerts.rules").unlink()
+
+    ctx.run(ctx.on.config_changed(), state)
+    assert (rules_dir / "alerts.rules").read_text() == "# no alerts\n"
+
+
+def test_new_resource_reapplies_snap_config(ctx, snap_cache, install_local, resource):
+    config = {**CONFIG, "snap-config": "a: 1"}
+    state = testing.State(config=config, resources={resource})
+    state = ctx.run(ctx.on.install(), state)
+    state = ctx.run(ctx.on.config_changed(), state)
+
+    resource.path.write_bytes(b"a newer snap")
+    state = ctx.run(ctx.on.upgrade_charm(), state)
+    ctx.run(ctx.on.config_changed(), state)
+    assert install_local.call_count == 2
+    assert snap_cache["local-exporter"].set.call_count == 2
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_cos_agent_only_with_relation(ctx, rules_dir):
+    relation = testing.Relation("cos-agent")
+    with ctx(ctx.on.update_status(), testing.State(config=CONFIG)) as manager:
+        assert manager.charm.cos is None
+    state = testing.State(config=CONFIG, relations={relation})
+    with ctx(ctx.on.update_status(), state) as manager:
+        assert manager.charm.cos is not None
+
+
+
+@pytest.mark.usefixtures("no_resource")
+def test_install_then_config_changed_status(ctx):
+    state = ctx.run(ctx.on.install(), testing.State(config=CONFIG))
+    assert state.unit_status == testing.MaintenanceStatus("snap installed")
+
+    state = ctx.run(ctx.on.config_changed(), state)
+    assert state.unit_status == testing.ActiveStatus("configured")
+
+
+def test_upgrade_then_config_changed_status(ctx, resource):
+    state = testing.State(config=CONFIG, resources={resource})
+    state = ctx.run(ctx.on.install(), state)
+    state = ctx.run(ctx.on.config_changed(), state)
+
+    state = ctx.run(ctx.on.upgrade_charm(), state)
+    assert state.unit_status == testing.MaintenanceStatus("snap installed")
+
+    # nothing changed, config-changed still settles the status
+    state = ctx.run(ctx.on.config_changed(), state)
+    assert state.unit_status == testing.ActiveStatus("configured")
+
+
+RAW_CONFIG = {
+    "exporter-port": 9100,
+    "snap-channel": "latest/stable",
+    "classic": False,
+    "metrics-path": "metrics",
+}
+
+
+def test_from_juju_passes_optional_fields():
+    config = ExporterConfig.from_juju({
+        **RAW_CONFIG,
+        "snap-name": "node-exporter",
+        "snap-config": "a: 1",
+        "alert-rules": "groups: []",
+    })
+    assert config == ExporterConfig(
+        exporter_port=9100,
+        snap_channel="latest/stable",
+        classic=False,
+        metrics_path="metrics",
+        snap_name="node-exporter",
+        snap_config="a: 1",
+        alert_rules="groups: []",
+    )
+
+
+def test_from_juju_optional_fields_default_to_none():
+    config = ExporterConfig.from_juju(RAW_CONFIG)
+    assert (config.snap_name, config.snap_config, config.alert_rules) == (None, None, None)
+
+
+def test_from_juju_coerces_port():
+    assert ExporterConfig.from_juju({**RAW_CONFIG, "exporter-port": "9100"}).exporter_port == 9100
+
+
+def test_from_juju_missing_keys():
+    raw = {"snap-channel": "latest/stable", "classic": False}
+    with pytest.raises(ValueError, match="Missing required config: exporter-port, metrics-path"):
+        ExporterConfig.from_juju(raw)
+
+
+@pytest.mark.parametrize("port", ["not-a-port", None, "9.5"])
+def test_from_juju_invalid_port(port):
+    with pytest.raises(ValueError, match="exporter-port must be an integer"):
+        ExporterConfig.from_juju({**RAW_CONFIG, "exporter-port": port})
+
+
+@pytest.mark.parametrize("classic", ["true", 1, None])
+def test_from_juju_invalid_classic(classic):
+    with pytest.raises(ValueError, match="classic must be a boolean"):
+        ExporterConfig.from_juju({**RAW_CONFIG, "classic": classic})